@@ -1,53 +1,192 @@
+import mmap
+import multiprocessing
 import os
+import shutil
+import sys
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import pydicom
-import pandas as pd
-from dicomanonymizer import anonymize_dicom_file
+from pydicom.datadict import keyword_for_tag
+from pydicom.tag import SequenceDelimiterTag, Tag
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+from pydicom.valuerep import EXPLICIT_VR_LENGTH_32
+import openpyxl
+from dicomanonymizer import get_private_tag, initialize_actions, simpledicomanonymizer
+
+# Number of threads used to scan the source directory
+SCAN_WORKERS = 32
+
+# Default dicomanonymizer rules, generated once per process
+DEFAULT_ANONYMIZATION_RULES = initialize_actions()
+
+# Start method of the processes anonymizing folders, forkserver avoids copying the parent process on Linux
+PROCESS_START_METHOD = "forkserver" if sys.platform.startswith("linux") else "spawn"
+
+MODALITY_TAG = Tag(0x0008, 0x0060)
+SERIES_INSTANCE_UID_TAG = Tag(0x0020, 0x000E)
+SOP_INSTANCE_UID_TAG = Tag(0x0008, 0x0018)
+SLICE_THICKNESS_TAG = Tag(0x0018, 0x0050)
+ROWS_TAG = Tag(0x0028, 0x0010)
+COLUMNS_TAG = Tag(0x0028, 0x0011)
+PIXEL_SPACING_TAG = Tag(0x0028, 0x0030)
 
 patient_headers = [
-    ["0008", "0012"],  # Instance Creation Date
-    ["0010", "0020"],  # Patient ID
-    ["0010", "0010"],  # Patient Name
-    ["0010", "0030"]   # Patient Date Of Birth
+    Tag(0x0008, 0x0012),  # Instance Creation Date
+    Tag(0x0010, 0x0020),  # Patient ID
+    Tag(0x0010, 0x0010),  # Patient Name
+    Tag(0x0010, 0x0030)   # Patient Date Of Birth
 ]
 
 anonymized_headers = [
-    ["0018", "0050"],  # Slice Thickness
-    ["0018", "0060"],  # KVP
-    ["0018", "1150"],  # Exposure Time
-    ["0018", "1151"],  # X-Ray Tube Current
-    ["0018", "9345"],  # CTDIvol
-    ["0028", "0101"],  # Bits Stored
-    ["0028", "0010"],  # Rows
-    ["0028", "0011"],  # Columns
-    ["0008", "0070"],  # Manufacturer
-    ["0008", "1090"],  # Manufacturer's Model Name
-    ["0018", "1020"],  # Software Versions
+    Tag(0x0018, 0x0050),  # Slice Thickness
+    Tag(0x0018, 0x0060),  # KVP
+    Tag(0x0018, 0x1150),  # Exposure Time
+    Tag(0x0018, 0x1151),  # X-Ray Tube Current
+    Tag(0x0018, 0x9345),  # CTDIvol
+    Tag(0x0028, 0x0101),  # Bits Stored
+    Tag(0x0028, 0x0010),  # Rows
+    Tag(0x0028, 0x0011),  # Columns
+    Tag(0x0008, 0x0070),  # Manufacturer
+    Tag(0x0008, 0x1090),  # Manufacturer's Model Name
+    Tag(0x0018, 0x1020),  # Software Versions
 ]
 
-def is_dicom_file(file_path):
-    """Check if the given file is a DICOM file."""
-    # Check if the path is a file
-    if not os.path.isfile(file_path):
+# DICOM Part 10 files start with a 128 byte preamble followed by the 'DICM' prefix
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_PREFIX = b"DICM"
+
+# File Meta Information Group Length (0002,0000) UL, explicit VR little endian
+META_GROUP_LENGTH_ELEMENT = b"\x02\x00\x00\x00UL\x04\x00"
+
+# The file meta information is usually a few hundred bytes long
+MAX_META_GROUP_LENGTH = 4096
+
+# Media Storage SOP Class UID of DICOMDIR files
+DICOMDIR_SOP_CLASS_UID = b"1.2.840.10008.1.3.10"
+
+# Value length of encapsulated pixel data and sequences
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# Directory Record Sequence, only present in DICOMDIR files
+DIRECTORY_RECORD_SEQUENCE_TAG = Tag(0x0004, 0x1220)
+
+def is_dicom_magic(file_path):
+    """Check if the given file starts with a DICOM preamble and isn't a DICOMDIR."""
+    try:
+        with open(file_path, "rb") as f:
+            f.seek(DICOM_PREAMBLE_LENGTH)
+            if f.read(len(DICOM_PREFIX)) != DICOM_PREFIX:
+                return False
+
+            # Look for the DICOMDIR SOP class in the file meta information
+            element = f.read(len(META_GROUP_LENGTH_ELEMENT) + 4)
+            if element[:len(META_GROUP_LENGTH_ELEMENT)] == META_GROUP_LENGTH_ELEMENT:
+                meta_length = int.from_bytes(element[len(META_GROUP_LENGTH_ELEMENT):], "little")
+                # Larger lengths are likely corrupt, leave them to pydicom instead of reading them
+                if meta_length <= MAX_META_GROUP_LENGTH:
+                    # Don't copy DICOMDIR files
+                    return DICOMDIR_SOP_CLASS_UID not in f.read(meta_length)
+    except OSError:
         return False
-    
+
+    # Ambiguous file meta information, fall back to reading the DICOM headers
     try:
-        # Attempt to read the file as a DICOM dataset
-        headers = pydicom.dcmread(file_path, stop_before_pixels=True)
+        headers = pydicom.dcmread(file_path, stop_before_pixels=True,
+                                  specific_tags=[DIRECTORY_RECORD_SEQUENCE_TAG], defer_size=1024)
         # Don't copy DICOMDIR files
         return headers.get('DirectoryRecordSequence') is None
     except (pydicom.errors.InvalidDicomError, FileNotFoundError):
         # If an error occurs, it's not a valid DICOM file
         return False
 
+def is_dicom_file(entry):
+    """Check if the given directory entry is a DICOM file."""
+    # Check if the entry is a file, using the stat cached by os.scandir
+    if not entry.is_file():
+        return False
+
+    return is_dicom_magic(entry.path)
+
+def read_instance_uids(file_path):
+    """Read the Series and SOP Instance UIDs of the given DICOM file, or None if it doesn't have both."""
+    try:
+        headers = pydicom.dcmread(file_path, stop_before_pixels=True,
+                                  specific_tags=[SERIES_INSTANCE_UID_TAG, SOP_INSTANCE_UID_TAG])
+    except (pydicom.errors.InvalidDicomError, OSError):
+        return None
+
+    series_uid = headers.get(SERIES_INSTANCE_UID_TAG)
+    sop_uid = headers.get(SOP_INSTANCE_UID_TAG)
+    if not series_uid or not sop_uid:
+        return None
+
+    return series_uid.value, sop_uid.value
+
+def scan_directory(dirpath):
+    """List the subdirectories and the sorted DICOM file names of the given directory, along with their first instance."""
+    subdirectories = []
+    dicom_files = []
+
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif is_dicom_file(entry):
+                    dicom_files.append(entry.name)
+    except OSError:
+        # Skip unreadable directories, like os.walk does
+        pass
+
+    # Sorted, so that the anonymized file names are deterministic
+    dicom_files.sort()
+
+    # Identify the first instance of the folder, to skip duplicated folders
+    instance_uids = read_instance_uids(os.path.join(dirpath, dicom_files[0])) if dicom_files else None
+
+    return subdirectories, dicom_files, instance_uids
+
 def find_dicom_folders(root_dir):
-    """Find all folders containing DICOM files within the given directory."""
-    dicom_folders = set()
-    
-    for dirpath, _, filenames in os.walk(root_dir):
-        contains_dicom = any(is_dicom_file(os.path.join(dirpath, filename)) for filename in filenames)
-        if contains_dicom:
-            dicom_folders.add(dirpath)
-    
+    """Find all folders containing DICOM files within the given directory, mapped to their DICOM file names."""
+    scanned_folders = {}
+    directories = [root_dir]
+
+    # Scanning is I/O bound, so directories are scanned concurrently by a pool of threads
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        pending = {}
+
+        while directories or pending:
+            # Bound the number of queued scans on large trees
+            while directories and len(pending) < 2 * SCAN_WORKERS:
+                dirpath = directories.pop()
+                pending[executor.submit(scan_directory, dirpath)] = dirpath
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirpath = pending.pop(future)
+                subdirectories, dicom_files, instance_uids = future.result()
+
+                directories.extend(subdirectories)
+                if dicom_files:
+                    scanned_folders[dirpath] = (dicom_files, instance_uids)
+
+    # Skip copies of an earlier folder, in path order so that the result is deterministic. A folder is
+    # only a copy if it starts with the same instance of the same series and has as many files, as a
+    # series can be split across folders (DIR000, DIR001, ...)
+    dicom_folders = {}
+    seen_folders = {}
+    for dirpath, (dicom_files, instance_uids) in sorted(scanned_folders.items()):
+        if instance_uids is not None:
+            folder_key = (*instance_uids, len(dicom_files))
+            if folder_key in seen_folders:
+                # Keep stdout to the found folders, which is what --list-only prints
+                print(f"Skipping folder {dirpath}, duplicate of {seen_folders[folder_key]}", file=sys.stderr)
+                continue
+
+            seen_folders[folder_key] = dirpath
+
+        dicom_folders[dirpath] = dicom_files
+
     return dicom_folders
 
 # Set patient name to 'P' follwed by the sequence number
@@ -67,93 +206,308 @@ def set_date_to_1900(dataset, tag):
     if element is not None:
         element.value = f"19000101"  # YYYYMMDD format
 
-def anonymize_file(source_file_path, destination_file_path, sequence_number):
+def find_element_end(source_file, offset, is_implicit_VR, is_little_endian):
+    """Find the end of the data element starting at the given offset, without reading its value."""
+    byteorder = "little" if is_little_endian else "big"
+    # Memory maps can't seek past their end, so the item lengths are checked against the file size
+    file_size = source_file.seek(0, os.SEEK_END)
+    if offset + 4 > file_size:
+        return None
+
+    source_file.seek(offset + 4)  # Skip the tag
+
+    if is_implicit_VR:
+        length_size = 4
+    elif source_file.read(2).decode("ascii", "replace") in EXPLICIT_VR_LENGTH_32:
+        source_file.read(2)  # Skip the reserved bytes
+        length_size = 4
+    else:
+        length_size = 2
+
+    length = source_file.read(length_size)
+    if len(length) < length_size:
+        return None
+
+    length = int.from_bytes(length, byteorder)
+    if length != UNDEFINED_LENGTH:
+        return source_file.tell() + length
+
+    # Encapsulated pixel data, skip the items up to the sequence delimiter
+    while True:
+        item = source_file.read(8)
+        if len(item) < 8:
+            return None
+
+        item_end = source_file.tell() + int.from_bytes(item[4:], byteorder)
+        if item_end > file_size:
+            return None
+
+        source_file.seek(item_end)
+        if Tag(int.from_bytes(item[:2], byteorder), int.from_bytes(item[2:4], byteorder)) == SequenceDelimiterTag:
+            return source_file.tell()
+
+def read_dicom_headers(source_file):
+    """Read the DICOM headers up to the pixel data, returning them along with the pixel data offset."""
+    # Map the file in memory, so that only the pages holding the headers are read from disk
+    with mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) as source_map:
+        headers = pydicom.dcmread(source_map, stop_before_pixels=True)
+        pixel_data_offset = source_map.tell()
+        file_size = len(source_map)
+
+        # Deflated datasets are decompressed in memory, and elements following the pixel data
+        # have to be anonymized as well, so read these files whole. Truncated pixel data is copied as is
+        pixel_data_end = (find_element_end(source_map, pixel_data_offset, *headers.original_encoding)
+                          if pixel_data_offset < file_size else None)
+        read_whole_file = (headers.file_meta.get("TransferSyntaxUID") == DeflatedExplicitVRLittleEndian
+                           or pixel_data_end is not None and pixel_data_end < file_size)
+
+    # Read from the file, as pydicom can seek past the end of truncated files but not of memory maps
+    if read_whole_file:
+        source_file.seek(0)
+        headers = pydicom.dcmread(source_file)
+        pixel_data_offset = source_file.tell()
+
+    return headers, pixel_data_offset
+
+def copy_file_tail(source_file, destination_file, offset):
+    """Append the source file, starting from the given offset, to the destination file."""
+    count = os.fstat(source_file.fileno()).st_size - offset
+    destination_file.flush()
+
+    # Let the kernel copy the data when possible
+    if hasattr(os, "copy_file_range"):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(source_file.fileno(), destination_file.fileno(), count, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                count -= copied
+        except OSError:
+            # Not supported by the file system, copy the rest in user space
+            pass
+
+    if count > 0:
+        source_file.seek(offset)
+        shutil.copyfileobj(source_file, destination_file)
+
+def folder_anonymization_rules(sequence_number):
+    """Merge the default anonymization rules with the ones specific to a folder."""
     extra_anonmymization_rules = {
         (0x0010, 0x0010): (set_patient_name_to_sequence(sequence_number)),  # Patient's Name
         (0x0010, 0x0030): (set_date_to_1900)  # Patient's Birth Date
     }
 
-    anonymize_dicom_file(source_file_path, destination_file_path, extra_anonmymization_rules)
+    return {**DEFAULT_ANONYMIZATION_RULES, **extra_anonmymization_rules}
 
-def copy_and_anonymize_dicom_files(dicom_folders, destination_dir, save_patient_metadata):
-    """Copy and anonymize DICOM files to the destination directory with sequential four-digit names."""
-    if not os.path.exists(destination_dir):
-        os.makedirs(destination_dir)
+def compile_anonymization_rules(anonymization_rules):
+    """Split the anonymization rules into individual tags, keyed by their integer value, and repeating groups."""
+    tag_rules = {}
+    range_rules = []
+
+    for tag, action in anonymization_rules.items():
+        if len(tag) > 2:
+            range_rules.append((tag, action))
+        else:
+            tag_rules[Tag(tag)] = action
+
+    return tag_rules, range_rules
+
+def anonymize_dataset(dataset, tag_rules, range_rules):
+    """Anonymize the dataset with compiled rules, like dicomanonymizer's anonymize_dataset does."""
+    private_tags = []
+
+    # Only the tags present in the dataset have something to anonymize
+    for tag in [tag for tag in dataset.keys() if tag in tag_rules]:
+        tag_rules[tag](dataset, tag)
+
+        element = dataset.get(tag)
+        if element and element.tag.is_private:
+            private_tags.append(get_private_tag(dataset, tag))
+
+    # The meta information header is located in the file_meta dataset
+    file_meta = getattr(dataset, "file_meta", None)
+    if file_meta is not None:
+        for tag in [tag for tag in file_meta.keys() if tag in tag_rules]:
+            tag_rules[tag](file_meta, tag)
+
+    # Walk the dataset once for all the repeating groups
+    def range_callback(dataset, data_element):
+        for (group, element, group_mask, element_mask), action in range_rules:
+            if (data_element.tag.group & group_mask == group & group_mask
+                    and data_element.tag.element & element_mask == element & element_mask):
+                action(dataset, data_element.tag)
+                if dataset.get(data_element.tag) and data_element.is_private:
+                    private_tags.append(get_private_tag(dataset, data_element.tag))
+
+    if range_rules:
+        dataset.walk(range_callback)
+
+    # Delete the private tags, except the ones with an anonymization rule
+    dataset.remove_private_tags()
+    for private_tag in private_tags:
+        creator = private_tag["creator"]
+        element = private_tag["element"]
+        block = dataset.private_block(creator["tagGroup"], creator["creatorName"], create=True)
+        if element is not None:
+            block.add_new(element["offset"], element["element"].VR, element["element"].value)
+
+def anonymize_file(dataset, source_file, pixel_data_offset, destination_file_path, anonymization_rules):
+    """Anonymize the dataset and write it to the destination file, returning the number of bytes written."""
+    anonymize_dataset(dataset, *anonymization_rules)
+
+    with open(destination_file_path, "wb") as destination_file:
+        dataset.save_as(destination_file)
+        # The pixel data isn't anonymized, copy it as is
+        copy_file_tail(source_file, destination_file, pixel_data_offset)
+
+        return destination_file.tell()
+
+def extract_folder_headers(headers, save_patient_metadata):
+    """Extract the headers saved in the folder mapping from a DICOM dataset."""
+    folder_info = {}
+
+    if save_patient_metadata:
+        for header_id in patient_headers:
+            elem = headers.get(header_id)
+            if elem:
+                folder_info[elem.keyword] = elem.value
+
+    modality = headers.get(MODALITY_TAG)
+    folder_info[modality.keyword] = modality.value
+
+    # Save extra headers for CT volumes
+    if modality.value == "CT":
+        # Calculate FOV
+        rows = headers.get(ROWS_TAG).value
+        columns = headers.get(COLUMNS_TAG).value
+        spacing = headers.get(PIXEL_SPACING_TAG)
+
+        if spacing:
+            folder_info['FOV'] = f"{columns * spacing[0]:.1f} x {rows * spacing[1]:.1f}"
+        else:
+            spacing = float(headers.get(SLICE_THICKNESS_TAG).value)
+            folder_info['FOV'] = f"{columns * spacing:.1f} x {rows * spacing:.1f}"
+
+        # Save extra headers
+        for header_id in anonymized_headers:
+            elem = headers.get(header_id)
+            if elem:
+                folder_info[elem.keyword] = elem.value
+
+    return folder_info
+
+def process_one_file(source_file_path, destination_file_path, anonymization_rules, extract_headers, save_patient_metadata):
+    """Copy and anonymize a DICOM file in a single read, returning the bytes written and the extracted headers."""
+    with open(source_file_path, "rb") as source_file:
+        headers, pixel_data_offset = read_dicom_headers(source_file)
+
+        # The headers have to be extracted before they're anonymized
+        folder_info = extract_folder_headers(headers, save_patient_metadata) if extract_headers else {}
+
+        return anonymize_file(headers, source_file, pixel_data_offset, destination_file_path, anonymization_rules), folder_info
+
+def set_uid_salt(uid_salt):
+    """Derive the anonymized UIDs from the original ones and the given salt."""
+    # dicomanonymizer generates random UIDs and remembers them per process, so folders anonymized
+    # by different workers would no longer share their Study or Frame of Reference UIDs
+    def get_uid(old_uid):
+        return f"2.25.{uuid.uuid5(uid_salt, str(old_uid)).int}"
+
+    simpledicomanonymizer.get_UID = get_uid
+
+def process_folder(task):
+    """Copy and anonymize the DICOM files of a single folder, returning its folder info and statistics."""
+    index_folder, folder, dicom_files, destination_dir, save_patient_metadata = task
+    print(f"Processing folder {index_folder}: {folder}")
+
+    folder_info = None
+    images_size = 0
+
+    new_folder_name = f"{index_folder:04}"  # Four-digit formatting
+    new_folder_path = os.path.join(destination_dir, new_folder_name)
     
-    total_folders_processed = 0
-    total_images_copied = 0
-    total_size_copied = 0
-    folder_info_list = []
+    os.makedirs(new_folder_path, exist_ok=True)
     
-    for index_folder, folder in enumerate(sorted(dicom_folders), start=1):
-        print(f"Processing folder {index_folder}: {folder}")
-        
-        new_folder_name = f"{index_folder:04}"  # Four-digit formatting
-        new_folder_path = os.path.join(destination_dir, new_folder_name)
-        
-        if not os.path.exists(new_folder_path):
-            os.makedirs(new_folder_path)
-        
-        dicom_files = [f for f in os.listdir(folder) if is_dicom_file(os.path.join(folder, f))]
-
-        for index_file, dicom_file in enumerate(sorted(dicom_files), start=1):
-            source_file_path = os.path.join(folder, dicom_file)
-            new_file_name = f"{index_file:04}.dcm"
-            destination_file_path = os.path.join(new_folder_path, new_file_name)
+    # The anonymization rules are the same for all the files in the folder
+    anonymization_rules = compile_anonymization_rules(folder_anonymization_rules(index_folder))
 
-            if index_file == 1:
-                folder_info = {"Original": folder}
-                headers = pydicom.dcmread(source_file_path, stop_before_pixels=True)
+    for index_file, dicom_file in enumerate(dicom_files, start=1):
+        source_file_path = os.path.join(folder, dicom_file)
+        new_file_name = f"{index_file:04}.dcm"
+        destination_file_path = os.path.join(new_folder_path, new_file_name)
 
-                if save_patient_metadata:
-                    for header_id in patient_headers:
-                        elem = headers.get(header_id)
-                        if elem:
-                            folder_info[elem.keyword] = elem.value
+        # Copy and anonymize the DICOM file, extracting the folder headers from the first one
+        file_size, headers = process_one_file(source_file_path, destination_file_path, anonymization_rules,
+                                              index_file == 1, save_patient_metadata)
+        images_size += file_size
 
-                folder_info["Anonymized"] = new_folder_name
+        if index_file == 1:
+            folder_info = {"Original": folder, "Anonymized": new_folder_name, **headers}
 
-                modality = headers.get(["0008", "0060"])  # Modality
-                folder_info[modality.keyword] = modality.value
+    return index_folder, folder_info, len(dicom_files), images_size
 
-                # Save extra headers for CT volumes
-                if modality.value == "CT":
-                    # Calculate FOV
-                    rows = headers.get(["0028","0010"]).value
-                    columns = headers.get(["0028","0011"]).value
-                    spacing = headers.get(["0028","0030"])
+def folder_mapping_columns(save_patient_metadata):
+    """List the columns of the folder mapping, in the order they're saved."""
+    columns = ["Original"]
+    if save_patient_metadata:
+        columns += [keyword_for_tag(header_id) for header_id in patient_headers]
+    columns += ["Anonymized", "Modality", "FOV"]
+    columns += [keyword_for_tag(header_id) for header_id in anonymized_headers]
 
-                    if spacing:
-                        folder_info['FOV'] = f"{columns * spacing[0]:.1f} x {rows * spacing[1]:.1f}"
-                    else:
-                        spacing = float(headers.get(["0018", "0050"]).value)
-                        folder_info['FOV'] = f"{columns * spacing:.1f} x {rows * spacing:.1f}"
+    return columns
 
-                    # Save extra headers
-                    for header_id in anonymized_headers:
-                        elem = headers.get(header_id)
-                        if elem:
-                            folder_info[elem.keyword] = elem.value
+def copy_and_anonymize_dicom_files(dicom_folders, destination_dir, save_patient_metadata):
+    """Copy and anonymize DICOM files to the destination directory with sequential four-digit names."""
+    os.makedirs(destination_dir, exist_ok=True)
+    
+    total_folders_processed = 0
+    total_images_copied = 0
+    total_size_copied = 0
 
-                folder_info_list.append(folder_info)
+    # The DICOM files of each folder were already found while scanning the source directory
+    tasks = [(index_folder, folder, dicom_files, destination_dir, save_patient_metadata)
+             for index_folder, (folder, dicom_files) in enumerate(sorted(dicom_folders.items()), start=1)]
 
-            # Copy and anonymize the DICOM file
-            anonymize_file(source_file_path, destination_file_path, index_folder)
+    # The folder mapping is stored by column, with a row for each anonymized folder
+    folder_mapping = {column: [None] * len(tasks) for column in folder_mapping_columns(save_patient_metadata)}
 
-            # Get the size of the copied file
-            file_size = os.path.getsize(destination_file_path)
-            total_size_copied += file_size
+    # Anonymization is CPU bound, so folders are processed in parallel by a pool of processes
+    # Anonymized UIDs are derived from a salt shared by all the workers, to keep them consistent across folders
+    uid_salt = uuid.uuid4()
+    with multiprocessing.get_context(PROCESS_START_METHOD).Pool(initializer=set_uid_salt, initargs=(uid_salt,)) as pool:
+        for index_folder, folder_info, images_copied, size_copied in pool.imap_unordered(process_folder, tasks, chunksize=1):
+            if folder_info is not None:
+                for column, values in folder_mapping.items():
+                    values[index_folder - 1] = folder_info.get(column)
 
-            total_images_copied += 1
-        
-        total_folders_processed += 1
+            total_images_copied += images_copied
+            total_size_copied += size_copied
+            total_folders_processed += 1
     
-    return total_folders_processed, total_images_copied, total_size_copied, folder_info_list
+    return total_folders_processed, total_images_copied, total_size_copied, folder_mapping
+
+def to_excel_value(value):
+    """Convert a DICOM value to a type that can be stored in an Excel cell."""
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+
+    return str(value)
 
 def save_folder_mapping_to_excel(folder_mapping, excel_path):
     """Save the folder mapping to an Excel file."""
-    df = pd.DataFrame(folder_mapping)
-    df.to_excel(excel_path, index=False)
+    # Skip the columns without any values, like FOV when there are no CT volumes
+    columns = {header: values for header, values in folder_mapping.items()
+               if any(value is not None for value in values)}
+
+    # Stream the rows to the file instead of building the whole worksheet in memory
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Sheet1")
+    worksheet.append(list(columns))
+    for row in zip(*columns.values()):
+        worksheet.append([to_excel_value(value) for value in row])
+
+    workbook.save(excel_path)
 
 if __name__ == "__main__":
     import argparse
@@ -0,0 +1,270 @@
+import contextlib
+import glob
+import io
+import mmap
+import multiprocessing
+import os
+import shutil
+import uuid
+
+import dicomanonymizer
+import openpyxl
+import pydicom
+import pytest
+from dicomanonymizer import simpledicomanonymizer
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+import main
+
+
+def write_series(folder, study_uid, frame_of_reference_uid, count=2, series_uid=None):
+    """Write a CT series with the given study and frame of reference to the folder."""
+    dataset = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    dataset.StudyInstanceUID = study_uid
+    dataset.FrameOfReferenceUID = frame_of_reference_uid
+    dataset.SeriesInstanceUID = series_uid or generate_uid()
+
+    os.makedirs(folder, exist_ok=True)
+    for index in range(count):
+        dataset.SOPInstanceUID = generate_uid()
+        dataset.save_as(os.path.join(folder, f"{index:04}.dcm"))
+
+
+def test_shared_uids_match_across_workers(tmp_path):
+    study_uid = generate_uid()
+    frame_of_reference_uid = generate_uid()
+    for name in ("series1", "series2", "series3"):
+        write_series(tmp_path / "source" / name, study_uid, frame_of_reference_uid)
+
+    dicom_folders = main.find_dicom_folders(str(tmp_path / "source"))
+    destination_dir = str(tmp_path / "destination")
+    tasks = [(index_folder, folder, dicom_files, destination_dir, False)
+             for index_folder, (folder, dicom_files) in enumerate(sorted(dicom_folders.items()), start=1)]
+
+    # Anonymize every folder in a fresh worker process
+    with multiprocessing.get_context(main.PROCESS_START_METHOD).Pool(
+            1, initializer=main.set_uid_salt, initargs=(uuid.uuid4(),), maxtasksperchild=1) as pool:
+        pool.map(main.process_folder, tasks, chunksize=1)
+
+    datasets = [pydicom.dcmread(path) for path in glob.glob(os.path.join(destination_dir, "*", "*.dcm"))]
+    assert len(datasets) == 6
+    assert len({dataset.StudyInstanceUID for dataset in datasets}) == 1
+    assert len({dataset.FrameOfReferenceUID for dataset in datasets}) == 1
+    assert len({dataset.SeriesInstanceUID for dataset in datasets}) == 3
+    assert len({dataset.SOPInstanceUID for dataset in datasets}) == 6
+    assert study_uid not in {dataset.StudyInstanceUID for dataset in datasets}
+
+
+@pytest.fixture
+def uid_salt(monkeypatch):
+    """Derive anonymized UIDs from a salt, restoring dicomanonymizer afterwards."""
+    monkeypatch.setattr(simpledicomanonymizer, "get_UID", simpledicomanonymizer.get_UID)
+    main.set_uid_salt(uuid.uuid4())
+
+
+@pytest.mark.parametrize("name", [
+    "MR_small_bigendian.dcm",  # Explicit VR big endian
+    "MR_small_implicit.dcm",  # Implicit VR little endian
+    "MR_small_padded.dcm",  # Trailing padding after the pixel data
+    "CT_small.dcm",  # Trailing padding after the pixel data
+    "image_dfl.dcm",  # Deflated
+    "JPEG2000.dcm",  # Encapsulated pixel data
+    "JPEG2000-embedded-sequence-delimiter.dcm",  # Encapsulated pixel data
+    "MR_small_RLE.dcm",  # Encapsulated pixel data
+    "examples_overlay.dcm",  # Overlay repeating groups
+    "nested_priv_SQ.dcm",  # Private sequences
+    "priv_SQ.dcm",  # Private sequences
+])
+def test_anonymized_file_matches_dicomanonymizer(tmp_path, uid_salt, name):
+    source_file_path = get_testdata_file(name)
+    anonymization_rules = main.folder_anonymization_rules(1)
+
+    dataset = pydicom.dcmread(source_file_path)
+    dicomanonymizer.anonymize_dataset(dataset, anonymization_rules)
+    expected = io.BytesIO()
+    dataset.save_as(expected)
+
+    destination_file_path = tmp_path / "0001.dcm"
+    file_size, _ = main.process_one_file(source_file_path, str(destination_file_path),
+                                         main.compile_anonymization_rules(anonymization_rules), False, False)
+
+    assert destination_file_path.read_bytes() == expected.getvalue()
+    assert file_size == len(expected.getvalue())
+
+
+@pytest.mark.parametrize("name", ["MR_small_bigendian.dcm", "MR_small_implicit.dcm", "JPEG2000.dcm"])
+def test_pixel_data_is_copied_verbatim(tmp_path, name):
+    source_file_path = get_testdata_file(name)
+    with open(source_file_path, "rb") as source_file:
+        headers, pixel_data_offset = main.read_dicom_headers(source_file)
+        source_file.seek(pixel_data_offset)
+        pixel_data = source_file.read()
+
+    destination_file_path = tmp_path / "0001.dcm"
+    main.process_one_file(source_file_path, str(destination_file_path),
+                          main.compile_anonymization_rules(main.folder_anonymization_rules(1)), False, False)
+
+    assert "PixelData" not in headers
+    assert pixel_data
+    assert destination_file_path.read_bytes().endswith(pixel_data)
+
+
+@pytest.mark.parametrize("truncated_length", [4, 20, 200, 280])
+def test_truncated_encapsulated_pixel_data_is_copied(tmp_path, truncated_length):
+    with open(get_testdata_file("JPEG2000.dcm"), "rb") as source_file:
+        data = source_file.read()
+    source_file_path = tmp_path / "source.dcm"
+    source_file_path.write_bytes(data[:-truncated_length])
+
+    with open(source_file_path, "rb") as source_file:
+        headers, pixel_data_offset = main.read_dicom_headers(source_file)
+        with mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) as source_map:
+            assert main.find_element_end(source_map, pixel_data_offset, *headers.original_encoding) is None
+
+    destination_file_path = tmp_path / "0001.dcm"
+    _, folder_info = main.process_one_file(str(source_file_path), str(destination_file_path),
+                                           main.compile_anonymization_rules(main.folder_anonymization_rules(1)),
+                                           True, False)
+
+    assert folder_info["Modality"] == "NM"
+    assert destination_file_path.read_bytes().endswith(data[pixel_data_offset:-truncated_length])
+
+
+def read_with_private_block(name):
+    """Read a bundled test file and add a private block with two elements to it."""
+    dataset = pydicom.dcmread(get_testdata_file(name))
+    block = dataset.private_block(0x0009, "DICOMFINDER TEST", create=True)
+    block.add_new(0x01, "LO", "kept")
+    block.add_new(0x02, "LO", "removed")
+
+    return dataset, block
+
+
+@pytest.mark.parametrize("name", ["CT_small.dcm", "examples_overlay.dcm", "nested_priv_SQ.dcm", "priv_SQ.dcm"])
+def test_anonymize_dataset_matches_dicomanonymizer(uid_salt, name):
+    expected, _ = read_with_private_block(name)
+    dataset, block = read_with_private_block(name)
+
+    # Private tags with a rule are kept, the other ones are removed
+    anonymization_rules = main.folder_anonymization_rules(1)
+    anonymization_rules[(block.group, block.block_start >> 8)] = simpledicomanonymizer.keep
+    anonymization_rules[(block.group, block.get_tag(0x01).element)] = simpledicomanonymizer.keep
+
+    dicomanonymizer.anonymize_dataset(expected, anonymization_rules)
+    main.anonymize_dataset(dataset, *main.compile_anonymization_rules(anonymization_rules))
+
+    assert dataset == expected
+
+    # The private block is restored from its creator, which may give it another slot
+    restored_block = dataset.private_block(block.group, block.private_creator)
+    assert restored_block[0x01].value == "kept"
+    assert 0x02 not in restored_block
+
+
+def test_find_dicom_folders_with_sidecar_files(tmp_path, monkeypatch):
+    write_series(tmp_path / "series", generate_uid(), generate_uid(), count=4)
+    for name in ("._0000.dcm", "._0001.dcm", "notes.txt", "Thumbs.db", "DICOMDIR", "a.txt", "b.txt", "c.txt"):
+        (tmp_path / "series" / name).write_bytes(b"\0" * 256)
+
+    # Directory listing order depends on the file system, list the sidecar files first
+    scandir = os.scandir
+
+    @contextlib.contextmanager
+    def scandir_sidecars_first(path):
+        with scandir(path) as entries:
+            yield iter(sorted(entries, key=lambda entry: entry.name[0].isdigit()))
+
+    monkeypatch.setattr(os, "scandir", scandir_sidecars_first)
+
+    assert main.find_dicom_folders(str(tmp_path)) == {
+        str(tmp_path / "series"): ["0000.dcm", "0001.dcm", "0002.dcm", "0003.dcm"],
+    }
+
+
+def test_find_dicom_folders_skips_copied_folders(tmp_path, capsys):
+    study_uid = generate_uid()
+    frame_of_reference_uid = generate_uid()
+    series_uid = generate_uid()
+    # A series split across folders, as on DICOMDIR media
+    write_series(tmp_path / "DIR000", study_uid, frame_of_reference_uid, count=3, series_uid=series_uid)
+    write_series(tmp_path / "DIR001", study_uid, frame_of_reference_uid, count=3, series_uid=series_uid)
+    shutil.copytree(tmp_path / "DIR000", tmp_path / "copy")
+    # A copy missing files isn't a duplicate
+    shutil.copytree(tmp_path / "DIR000", tmp_path / "partial")
+    os.remove(tmp_path / "partial" / "0002.dcm")
+
+    assert main.find_dicom_folders(str(tmp_path)) == {
+        str(tmp_path / "DIR000"): ["0000.dcm", "0001.dcm", "0002.dcm"],
+        str(tmp_path / "DIR001"): ["0000.dcm", "0001.dcm", "0002.dcm"],
+        str(tmp_path / "partial"): ["0000.dcm", "0001.dcm"],
+    }
+    # --list-only prints the found folders to stdout
+    output = capsys.readouterr()
+    assert output.out == ""
+    assert output.err == f"Skipping folder {tmp_path / 'copy'}, duplicate of {tmp_path / 'DIR000'}\n"
+
+
+def test_is_dicom_magic_skips_dicomdir_without_parsing_it(monkeypatch):
+    def dcmread(*args, **kwargs):
+        raise AssertionError("The DICOMDIR file meta information should be enough")
+
+    monkeypatch.setattr(pydicom, "dcmread", dcmread)
+
+    assert not main.is_dicom_magic(get_testdata_file("DICOMDIR"))
+    assert main.is_dicom_magic(get_testdata_file("CT_small.dcm"))
+
+
+def write_file(folder, name, **elements):
+    """Copy a pydicom test file to the folder, with some of its elements replaced."""
+    dataset = pydicom.dcmread(get_testdata_file(name))
+    for keyword, value in elements.items():
+        setattr(dataset, keyword, value)
+
+    os.makedirs(folder, exist_ok=True)
+    dataset.save_as(os.path.join(folder, "0000.dcm"))
+
+
+def read_excel_rows(excel_path):
+    workbook = openpyxl.load_workbook(excel_path)
+    return list(workbook.active.iter_rows(values_only=True))
+
+
+def test_save_folder_mapping_to_excel(tmp_path):
+    write_file(tmp_path / "source" / "ct", "CT_small.dcm", SoftwareVersions=["1.0", "2.0"])
+    write_file(tmp_path / "source" / "mr", "MR_small.dcm")
+    dicom_folders = main.find_dicom_folders(str(tmp_path / "source"))
+    *_, folder_mapping = main.copy_and_anonymize_dicom_files(dicom_folders, str(tmp_path / "destination"), True)
+
+    excel_path = tmp_path / "folders.xlsx"
+    main.save_folder_mapping_to_excel(folder_mapping, excel_path)
+    header, ct_row, mr_row = read_excel_rows(excel_path)
+
+    # CTDIvol isn't in any of the files
+    assert header == ("Original", "InstanceCreationDate", "PatientID", "PatientName", "PatientBirthDate",
+                      "Anonymized", "Modality", "FOV", "SliceThickness", "KVP", "ExposureTime", "XRayTubeCurrent",
+                      "BitsStored", "Rows", "Columns", "Manufacturer", "ManufacturerModelName", "SoftwareVersions")
+    ct_row = dict(zip(header, ct_row))
+    mr_row = dict(zip(header, mr_row))
+    assert ct_row["Original"] == str(tmp_path / "source" / "ct")
+    assert ct_row["Anonymized"] == "0001"
+    assert ct_row["PatientName"] == "CompressedSamples^CT1"
+    assert ct_row["SoftwareVersions"] == "['1.0', '2.0']"
+    assert ct_row["FOV"] == "84.7 x 84.7"
+    assert mr_row["Modality"] == "MR"
+    assert mr_row["PatientName"] == "CompressedSamples^MR1"
+    assert mr_row["FOV"] is None
+
+
+def test_save_folder_mapping_to_excel_skips_empty_columns(tmp_path):
+    write_file(tmp_path / "source" / "mr", "MR_small.dcm")
+    dicom_folders = main.find_dicom_folders(str(tmp_path / "source"))
+    *_, folder_mapping = main.copy_and_anonymize_dicom_files(dicom_folders, str(tmp_path / "destination"), False)
+
+    excel_path = tmp_path / "folders.xlsx"
+    main.save_folder_mapping_to_excel(folder_mapping, excel_path)
+
+    assert read_excel_rows(excel_path) == [
+        ("Original", "Anonymized", "Modality"),
+        (str(tmp_path / "source" / "mr"), "0001", "MR"),
+    ]